@@ -1,15 +1,22 @@
-import json
+import asyncio
+import base64
+import hashlib
 import os
 import pathlib
 import re
-from typing import Optional
+from contextlib import asynccontextmanager
+from typing import Iterable, Iterator, Optional
 
+import httpx
+import numpy as np
+import orjson
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAioHttpClient
 from pydantic import BaseModel, Field
 
 # Load .env from the same directory as this file (local dev only)
@@ -17,14 +24,41 @@ load_dotenv(pathlib.Path(__file__).parent / ".env")
 
 EMBED_MODEL = "text-embedding-3-small"
 
+# One client per event loop so requests share the connection pool (keep-alive + TLS sessions).
+# Keyed by loop because the client's session is bound to the loop that created it, and some
+# hosts (serverless entry points, test clients) don't keep a single loop for the process.
+# The aiohttp transport holds up much better than the default httpx one under concurrent load.
+_CLIENTS: dict[asyncio.AbstractEventLoop, AsyncOpenAI] = {}
+
 
 def _get_openai_client() -> AsyncOpenAI:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY is not set")
-    return AsyncOpenAI(api_key=api_key)
+    loop = asyncio.get_running_loop()
+    client = _CLIENTS.get(loop)
+    if client is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("OPENAI_API_KEY is not set")
+        # Drop clients left behind by loops that have since closed. Their aiohttp sessions can't
+        # be closed without a running loop, so they are just released for the GC.
+        for closed in [other for other in _CLIENTS if other.is_closed()]:
+            del _CLIENTS[closed]
+        client = _CLIENTS[loop] = AsyncOpenAI(
+            api_key=api_key,
+            http_client=DefaultAioHttpClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            ),
+        )
+    return client
+
 
-app = FastAPI(title="ChatSearch")
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    yield
+    client = _CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+app = FastAPI(title="ChatSearch", lifespan=_lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,30 +66,52 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compresses JSON/HTML/JS/CSS responses; Starlette >= 0.46 leaves text/event-stream (/api/chat) alone
+app.add_middleware(GZipMiddleware, minimum_size=512)
 
 _PUBLIC = pathlib.Path(__file__).parent.parent / "public"
 
 # Read index.html once at startup (available locally; on Vercel the CDN serves
-# static assets but the function still handles / so we need the HTML here too)
+# static assets but the function still handles / so we need the HTML here too).
+# _INDEX_BYTES and _INDEX_ETAG are filled in below _FALLBACK_HTML.
 _INDEX_FILE = _PUBLIC / "index.html"
+_FAVICON_FILE = _PUBLIC / "whatsapp-logo.webp"
+_FAVICON_BYTES = _FAVICON_FILE.read_bytes() if _FAVICON_FILE.exists() else None
 
 
 @app.get("/", include_in_schema=False)
-async def _index():
-    if _INDEX_FILE.exists():
-        return FileResponse(str(_INDEX_FILE))
-    return HTMLResponse(_FALLBACK_HTML)
+async def _index(request: Request):
+    # Same no-cache policy as /index.html via _CachedStaticFiles; the ETag keeps revalidation to a 304.
+    headers = {"Cache-Control": "no-cache", "ETag": _INDEX_ETAG}
+    if _INDEX_ETAG in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(_INDEX_BYTES, media_type="text/html", headers=headers)
 
 
 @app.get("/favicon.ico", include_in_schema=False)
 async def _favicon():
-    ico = _PUBLIC / "whatsapp-logo.webp"
-    return FileResponse(str(ico), media_type="image/webp") if ico.exists() else HTMLResponse("", status_code=404)
+    if _FAVICON_BYTES is None:
+        return HTMLResponse("", status_code=404)
+    return Response(_FAVICON_BYTES, media_type="image/webp", headers={"Cache-Control": "public, max-age=604800"})
+
+
+class _CachedStaticFiles(StaticFiles):
+    """StaticFiles with explicit Cache-Control. File names aren't content-hashed, so
+    HTML/JS/CSS must revalidate on every load (a cheap 304 via ETag); images can be kept longer.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if str(full_path).endswith((".html", ".js", ".css")):
+            response.headers["Cache-Control"] = "no-cache"
+        else:
+            response.headers["Cache-Control"] = "public, max-age=604800"
+        return response
 
 
 # Local dev: mount public/ so JS/CSS/assets are served by uvicorn too
 if _PUBLIC.exists():
-    app.mount("/", StaticFiles(directory=str(_PUBLIC), html=True), name="static")
+    app.mount("/", _CachedStaticFiles(directory=str(_PUBLIC), html=True), name="static")
 
 
 _FALLBACK_HTML = """<!DOCTYPE html>
@@ -207,6 +263,9 @@ _FALLBACK_HTML = """<!DOCTYPE html>
 </body>
 </html>"""
 
+_INDEX_BYTES = _INDEX_FILE.read_bytes() if _INDEX_FILE.exists() else _FALLBACK_HTML.encode()
+_INDEX_ETAG = '"%s"' % hashlib.md5(_INDEX_BYTES).hexdigest()
+
 
 class Message(BaseModel):
     time: str
@@ -222,7 +281,20 @@ class ParsedChat(BaseModel):
     title: Optional[str] = None
 
 
-MEDIA_OMITTED = re.compile(r"<[^>]*(?:omitted|attached)[^>]*>", re.IGNORECASE)
+def _is_media(text: str) -> bool:
+    """True if text has a <…omitted…> / <…attached…> marker (case-insensitive).
+
+    Same matches as the regex <[^>]*(?:omitted|attached)[^>]*>, but a linear scan: the regex
+    retries from every '<' and goes quadratic on long lines full of '<' with no closing '>'.
+    A match is a '>'-terminated segment where the keyword follows the segment's first '<'.
+    """
+    if "<" not in text:
+        return False
+    for seg in text.lower().split(">")[:-1]:
+        lt = seg.find("<")
+        if lt != -1 and ("omitted" in seg[lt:] or "attached" in seg[lt:]):
+            return True
+    return False
 
 # Two common WhatsApp export formats:
 #
@@ -230,35 +302,18 @@ MEDIA_OMITTED = re.compile(r"<[^>]*(?:omitted|attached)[^>]*>", re.IGNORECASE)
 # Format B (no brackets, EU date): 03/12/2025, 15:29 - Sender: text
 # Format C (iOS export): [17.05.24, 03:40:31] Sender: text  (date first in brackets; some lines have leading U+200E)
 #
-# All are tried; whichever format dominates the file is used first; others still match for mixed/continuation lines.
+# All are matched by one alternation regex; the named group that matched tells which format the line is.
 
 _TIME = r"\d{1,2}:\d{2}(?::\d{2})?(?:\u202f?[APap][Mm])?"
 _DATE = r"\d{1,2}[/.\-]\d{1,2}[/.\-]\d{2,4}"
 
-# Format A: [time, date] Sender: text
-_FMT_A = re.compile(
-    rf"^\[({_TIME}),\s*({_DATE})\]\s+([^:]+):\s*(.*)"
+_FMT_ANY = re.compile(
+    rf"^(?:"
+    rf"\[(?P<a_time>{_TIME}),\s*(?P<a_date>{_DATE})\]"                    # A: [time, date]
+    rf"|(?P<b_date>{_DATE}),\s*(?P<b_time>{_TIME})\s+-"                    # B: date, time -
+    rf"|[\u200e\u200f\s]*\[(?P<c_date>{_DATE}),\s*(?P<c_time>{_TIME})\]"  # C: optional LTR mark, [date, time]
+    rf")\s+(?P<sender>[^:]+):\s*(?P<text>.*)"
 )
-# Format B: date, time - Sender: text
-_FMT_B = re.compile(
-    rf"^({_DATE}),\s*({_TIME})\s+-\s+([^:]+):\s*(.*)"
-)
-# Format C (iOS): optional LTR mark then [date, time] Sender: text
-_FMT_C = re.compile(
-    rf"^[\u200e\u200f\s]*\[({_DATE}),\s*({_TIME})\]\s+([^:]+):\s*(.*)"
-)
-# Format B system line (no sender after dash): date, time - system text
-_FMT_B_SYS = re.compile(
-    rf"^{_DATE},\s*{_TIME}\s+-\s+[^:]+$"
-)
-
-
-def _parse_fmt_a(line: str):
-    m = _FMT_A.match(line)
-    if not m:
-        return None
-    time, date, sender, text = m.groups()
-    return time.strip(), date.strip(), sender.strip(), text
 
 
 def _expand_year(y: str) -> str:
@@ -267,128 +322,103 @@ def _expand_year(y: str) -> str:
     return y
 
 
-def _parse_fmt_b(line: str):
-    m = _FMT_B.match(line)
-    if not m:
-        return None
-    date, time, sender, text = m.groups()
+def _day_first_to_us(date: str) -> str:
+    """Reorder a day-first date (formats B and C) to month/day/year."""
     parts = re.split(r"[/.\-]", date)
     if len(parts) == 3:
         d, mo, y = parts
         date = f"{mo}/{d}/{_expand_year(y)}"
-    return time.strip(), date.strip(), sender.strip(), text
-
-
-def _parse_fmt_c(line: str):
-    """iOS export: [date, time] Sender: text (date first in brackets)."""
-    m = _FMT_C.match(line)
-    if not m:
-        return None
-    date, time, sender, text = m.groups()
-    parts = re.split(r"[/.\-]", date.strip())
-    if len(parts) == 3:
-        d, mo, y = parts
-        date = f"{mo}/{d}/{_expand_year(y)}"
-    return time.strip(), date.strip(), sender.strip(), text
+    return date
 
 
-def _detect_dominant_format(lines: list[str]) -> str:
-    """Return 'A', 'B', or 'C' by prevalence of message-start lines.
-    Count every line that matches a format, except: do not count A/B when they
-    appear right after a C (or other format) line — those are likely pasted
-    content, not real message starts.
+def _iter_lines(stream: Iterable[bytes]) -> Iterator[str]:
+    """Decode an uploaded file line by line, treating CRLF, LF and bare CR as line breaks.
+    Lines that are not valid UTF-8 fall back to latin-1.
     """
-    def which(line: str) -> str:
-        if _FMT_A.match(line):
-            return "A"
-        if _FMT_B.match(line):
-            return "B"
-        if _FMT_C.match(line):
-            return "C"
-        return ""
-
-    a = b = c = 0
-    prev = ""
-    for line in lines:
-        w = which(line)
-        if w == "A":
-            if prev != "C":
-                a += 1
-        elif w == "B":
-            if prev != "C":
-                b += 1
-        elif w == "C":
-            c += 1
-        prev = w
-    if c >= a and c >= b:
-        return "C"
-    return "A" if a >= b else "B"
+    first = True
+    for raw in stream:
+        try:
+            line = raw.decode("utf-8")
+        except UnicodeDecodeError:
+            line = raw.decode("latin-1")
+        if first:
+            line = line.lstrip("\ufeff")
+            first = False
+        line = line.removesuffix("\n").removesuffix("\r")
+        yield from line.split("\r")
 
 
-def parse_chat(content: str) -> ParsedChat:
-    content = content.lstrip("\ufeff").replace("\r\n", "\n").replace("\r", "\n")
-    lines = content.split("\n")
+def parse_chat(lines: Iterable[str]) -> ParsedChat:
+    """Parse WhatsApp export lines in a single pass.
 
-    dominant = _detect_dominant_format(lines)
-    parsers = [_parse_fmt_a, _parse_fmt_b, _parse_fmt_c]
-    primary_idx = {"A": 0, "B": 1, "C": 2}[dominant]
-    parse_primary = parsers[primary_idx]
-    parse_secondary = parsers[(primary_idx + 1) % 3]
-    parse_tertiary = parsers[(primary_idx + 2) % 3]
+    The dominant format (by prevalence of message-start lines) only decides whose senders
+    count as participants, so it is settled at the end. A/B lines right after a C line are
+    not counted — those are likely pasted content, not real message starts.
 
+    Fields come straight from regex groups, so messages are built with model_construct
+    (no per-message validation).
+    """
+    counts = {"A": 0, "B": 0, "C": 0}
+    participants: dict[str, dict[str, None]] = {"A": {}, "B": {}, "C": {}}  # dicts as ordered sets
     messages: list[Message] = []
-    participants: set[str] = set()
     current: Optional[dict] = None
+    text_parts: list[str] = []  # current message's first line + continuations, joined on flush
+    prev = ""
 
     for line in lines:
-        parsed = parse_primary(line) or parse_secondary(line) or parse_tertiary(line)
-        if parsed:
+        m = _FMT_ANY.match(line)
+        fmt = ""
+
+        if m:
+            if m["a_time"]:
+                fmt, time, date = "A", m["a_time"], m["a_date"]
+            elif m["b_time"]:
+                fmt, time, date = "B", m["b_time"], _day_first_to_us(m["b_date"])
+            else:
+                fmt, time, date = "C", m["c_time"], _day_first_to_us(m["c_date"])
+            if fmt == "C" or prev != "C":
+                counts[fmt] += 1
             if current:
-                messages.append(Message(**current))
-            time, date, sender, text = parsed
-            # Only count sender as participant when line matches dominant format (not pasted content)
-            if parse_primary(line):
-                participants.add(sender)
-            text = text.strip().lstrip("\u200e\u200f")  # iOS sometimes puts LTR mark in message body
+                messages.append(Message.model_construct(text="\n".join(text_parts), **current))
+            sender = m["sender"].strip()
+            participants[fmt][sender] = None
+            text = m["text"].strip().lstrip("\u200e\u200f")  # iOS sometimes puts LTR mark in message body
             current = {
                 "time": time,
                 "date": date,
                 "sender": sender,
-                "text": text,
-                "is_media": bool(MEDIA_OMITTED.search(text)),
+                "is_media": _is_media(text),
             }
-        elif current is not None:
-            # Could be a genuine multiline continuation OR a pasted foreign-format message.
-            if line.strip():
-                sec = parse_secondary(line) or parse_tertiary(line)
-                if sec:
-                    _, _, sec_sender, sec_text = sec
-                    current["text"] += f"\n{sec_sender}: {sec_text.strip()}"
-                else:
-                    current["text"] += "\n" + line
+            text_parts = [text]
+        elif current is not None and line.strip():
+            # Multiline continuation
+            text_parts.append(line)
+        prev = fmt
 
     if current:
-        messages.append(Message(**current))
+        messages.append(Message.model_construct(text="\n".join(text_parts), **current))
+
+    a, b, c = counts["A"], counts["B"], counts["C"]
+    if c >= a and c >= b:
+        dominant = "C"
+    else:
+        dominant = "A" if a >= b else "B"
 
     return ParsedChat(
         messages=messages,
-        participants=sorted(participants),
+        participants=sorted(participants[dominant]),
         title=None,
     )
 
 
 @app.post("/api/parse", response_model=ParsedChat)
-async def parse_chat_file(file: UploadFile = File(...)):
+def parse_chat_file(file: UploadFile = File(...)):
+    # Sync handler: FastAPI runs it in the threadpool, so reading the spooled upload
+    # line by line doesn't block the event loop.
     if not file.filename or not file.filename.lower().endswith(".txt"):
         raise HTTPException(status_code=400, detail="Only .txt files are supported")
 
-    raw = await file.read()
-    try:
-        content = raw.decode("utf-8")
-    except UnicodeDecodeError:
-        content = raw.decode("latin-1")
-
-    result = parse_chat(content)
+    result = parse_chat(_iter_lines(file.file))
     if not result.messages:
         raise HTTPException(status_code=422, detail="No messages found. Make sure the file is a WhatsApp chat export.")
 
@@ -402,7 +432,17 @@ class EmbedRequest(BaseModel):
 
 
 class EmbedResponse(BaseModel):
-    embeddings: list[list[float]]
+    embeddings: list[str]   # base64 int8 vector per chunk (see _quantize_int8)
+
+
+def _quantize_int8(items) -> list[str]:
+    """Quantize base64 float32 embeddings to int8 with a per-vector scale (max |x| -> 127).
+    The scale itself is dropped: the client re-normalizes rows and cosine is scale-invariant.
+    """
+    vecs = np.stack([np.frombuffer(base64.b64decode(item.embedding), dtype=np.float32) for item in items])
+    scale = np.abs(vecs).max(axis=1, keepdims=True).clip(min=1e-12)
+    q8 = np.rint(vecs * (127.0 / scale)).astype(np.int8)
+    return [base64.b64encode(row.tobytes()).decode("ascii") for row in q8]
 
 
 @app.post("/api/embed", response_model=EmbedResponse)
@@ -416,12 +456,12 @@ async def embed_chunks(req: EmbedRequest):
         response = await _get_openai_client().embeddings.create(
             model=EMBED_MODEL,
             input=req.chunks,
+            encoding_format="base64",  # raw float32 bytes; skips building float lists
         )
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"OpenAI error: {e}")
 
-    embeddings = [item.embedding for item in response.data]
-    return EmbedResponse(embeddings=embeddings)
+    return EmbedResponse(embeddings=_quantize_int8(response.data))
 
 
 class QueryEmbedRequest(BaseModel):
@@ -468,12 +508,16 @@ class ExpandQueriesRequest(BaseModel):
     question: str
 
 
+class ExpandQueriesResponse(BaseModel):
+    queries: list[str]
+
+
 _EXPAND_QUERIES_SYSTEM = """You help turn a user question about a WhatsApp chat into search queries for finding relevant messages.
 Output exactly 5 short, diverse search queries that would retrieve relevant chat excerpts. Use keywords, topics, names, dates — not full sentences.
 Each query should be a different angle or rephrasing to maximize recall."""
 
 
-@app.post("/api/ask/expand-queries")
+@app.post("/api/ask/expand-queries", response_model=ExpandQueriesResponse)
 async def expand_queries(req: ExpandQueriesRequest):
     """Generate 5 RAG-oriented search queries from the user question using structured output."""
     if not req.question.strip():
@@ -503,7 +547,7 @@ async def expand_queries(req: ExpandQueriesRequest):
         raise HTTPException(status_code=502, detail="Empty response from model")
     try:
         parsed = RagQueriesOutput.model_validate_json(content)
-        return {"queries": parsed.queries}
+        return ExpandQueriesResponse(queries=parsed.queries)
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Invalid structured response: {e}")
 
@@ -514,6 +558,9 @@ Use the provided excerpts as your primary source. Be concise, direct, and conver
 When quoting messages include the sender's name. If the excerpts don't contain enough information, say so honestly."""
 
 
+_SSE_DONE = b"data: [DONE]\n\n"
+
+
 @app.post("/api/chat")
 async def chat(req: ChatRequest):
     """Streaming chat completion with optional RAG context injected per turn."""
@@ -552,10 +599,10 @@ async def chat(req: ChatRequest):
                 delta = chunk.choices[0].delta.content if chunk.choices else None
                 if delta:
                     # SSE format: data: <json>\n\n
-                    yield f"data: {json.dumps({'content': delta})}\n\n"
-            yield "data: [DONE]\n\n"
+                    yield b"data: " + orjson.dumps({"content": delta}) + b"\n\n"
+            yield _SSE_DONE
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield b"data: " + orjson.dumps({"error": str(e)}) + b"\n\n"
 
     return StreamingResponse(
         generate(),
@@ -565,3 +612,12 @@ async def chat(req: ChatRequest):
             "X-Accel-Buffering": "no",
         },
     )
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # "auto" picks uvloop/httptools when installed (uvicorn[standard]) and falls back where
+    # they aren't (uvloop is skipped on Windows). Keep idle connections alive longer than the
+    # usual 60 s proxy timeout so keep-alive is reused.
+    uvicorn.run(app, loop="auto", http="auto", timeout_keep_alive=75)
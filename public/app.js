@@ -53,7 +53,7 @@ let pendingFile   = null;
 // Context search state
 let currentRawBytes   = null;  // ArrayBuffer of the uploaded .txt file
 let currentChunks     = null;  // string[] — overlapping message chunks
-let currentEmbeddings = null;  // float[][] — one vector per chunk (from cache or API)
+let currentEmbeddings = null;  // { data: Float32Array, dim, count } — row-normalized, one row per chunk
 let searchMode        = 'literal'; // 'literal' | 'context' | 'ask'
 
 // Ask mode state
@@ -711,17 +711,43 @@ function buildChunks(messages) {
 // ── IndexedDB cache ───────────────────────────────────────────────────────────
 const IDB_NAME    = 'chatsearch';
 const IDB_STORE   = 'embeddings';
-const IDB_VERSION = 1;
+const IDB_CHUNKS  = 'chunk_embeddings';  // { vec: Int8Array, at } keyed by model + chunk text hash
+const IDB_VERSION = 4;
+
+const EMBED_MODEL     = 'text-embedding-3-small';  // keep in sync with EMBED_MODEL in backend/main.py
+const CHUNK_CACHE_MAX = 20000;                     // per-chunk entries kept; least recently used go first
+
+let idbPromise = null;  // one shared connection; reset if opening fails or another tab upgrades
 
 function openIDB() {
-  return new Promise((resolve, reject) => {
+  if (idbPromise) return idbPromise;
+  idbPromise = new Promise((resolve, reject) => {
     const req = indexedDB.open(IDB_NAME, IDB_VERSION);
     req.onupgradeneeded = e => {
-      e.target.result.createObjectStore(IDB_STORE);
+      const db = e.target.result;
+      if (!db.objectStoreNames.contains(IDB_STORE)) db.createObjectStore(IDB_STORE);
+      // v1/v2 kept float vectors per file; those entries are never read again
+      if (e.oldVersion > 0 && e.oldVersion < 3) e.target.transaction.objectStore(IDB_STORE).clear();
+      // Before v4 chunk entries were bare vectors without a model in the key or a timestamp
+      if (e.oldVersion < 4) {
+        if (db.objectStoreNames.contains(IDB_CHUNKS)) db.deleteObjectStore(IDB_CHUNKS);
+        db.createObjectStore(IDB_CHUNKS).createIndex('at', 'at');
+      }
+    };
+    let blocked = false;
+    req.onsuccess = e => {
+      const db = e.target.result;
+      if (blocked) { db.close(); return; }  // we already gave up on this open
+      // Let a newer version in another tab upgrade instead of blocking on this connection
+      db.onversionchange = () => { db.close(); idbPromise = null; };
+      resolve(db);
     };
-    req.onsuccess = e => resolve(e.target.result);
     req.onerror   = () => reject(req.error);
+    // An older tab still holds the previous version open; callers fall back to no cache
+    req.onblocked = () => { blocked = true; reject(new Error('IndexedDB upgrade blocked by another tab')); };
   });
+  idbPromise.catch(() => { idbPromise = null; });
+  return idbPromise;
 }
 
 async function idbGet(key) {
@@ -744,6 +770,55 @@ async function idbPut(key, value) {
   });
 }
 
+/** Fetch many keys from one store in a single transaction; missing keys come back as null. */
+async function idbGetMany(store, keys) {
+  const db = await openIDB();
+  return new Promise((resolve, reject) => {
+    const tx      = db.transaction(store, 'readonly');
+    const results = new Array(keys.length).fill(null);
+    keys.forEach((key, i) => {
+      const req = tx.objectStore(store).get(key);
+      req.onsuccess = () => { results[i] = req.result ?? null; };
+    });
+    tx.oncomplete = () => resolve(results);
+    tx.onerror    = () => reject(tx.error);
+  });
+}
+
+async function idbPutMany(store, entries) {
+  const db = await openIDB();
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(store, 'readwrite');
+    for (const [key, value] of entries) tx.objectStore(store).put(value, key);
+    tx.oncomplete = () => resolve();
+    tx.onerror    = () => reject(tx.error);
+  });
+}
+
+/** Delete the least recently used entries (by their `at` index) beyond `max`. */
+async function idbTrimOldest(store, max) {
+  const db = await openIDB();
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(store, 'readwrite');
+    const os = tx.objectStore(store);
+    const countReq = os.count();
+    countReq.onsuccess = () => {
+      let excess = countReq.result - max;
+      if (excess <= 0) return;
+      const cursorReq = os.index('at').openKeyCursor();
+      cursorReq.onsuccess = () => {
+        const cursor = cursorReq.result;
+        if (!cursor || excess <= 0) return;
+        os.delete(cursor.primaryKey);
+        excess--;
+        cursor.continue();
+      };
+    };
+    tx.oncomplete = () => resolve();
+    tx.onerror    = () => reject(tx.error);
+  });
+}
+
 async function sha256Hex(buffer) {
   const hashBuf = await crypto.subtle.digest('SHA-256', buffer);
   return Array.from(new Uint8Array(hashBuf))
@@ -768,7 +843,7 @@ async function ensureEmbeddings() {
   if (currentRawBytes) {
     try {
       const hash = await sha256Hex(currentRawBytes);
-      cacheKey = `embed_v1_${hash}`;
+      cacheKey = `embed_v3_${EMBED_MODEL}_${hash}`;
     } catch {
       cacheKey = null;
     }
@@ -778,8 +853,9 @@ async function ensureEmbeddings() {
   if (cacheKey) {
     try {
       const cached = await idbGet(cacheKey);
-      if (cached && cached.embeddings && cached.embeddings.length === currentChunks.length) {
-        currentEmbeddings = cached.embeddings;
+      // Stored as int8 rows (4× smaller than Float32); normalized into the search matrix on load
+      if (cached && Array.isArray(cached.rows) && cached.rows.length === currentChunks.length) {
+        currentEmbeddings = buildEmbeddingMatrix(cached.rows);
         embedInProgress   = false;
         onEmbeddingsReady();
         return;
@@ -789,36 +865,91 @@ async function ensureEmbeddings() {
     }
   }
 
+  // Reuse per-chunk vectors from earlier uploads (e.g. a re-export with a few new messages)
+  const vectors   = new Array(currentChunks.length).fill(null);
+  let   chunkKeys = null;
+  try {
+    const encoder = new TextEncoder();
+    chunkKeys = await Promise.all(
+      currentChunks.map(async c => `chunk_v4_${EMBED_MODEL}_${await sha256Hex(encoder.encode(c))}`),
+    );
+    const cached = await idbGetMany(IDB_CHUNKS, chunkKeys);
+    const now    = Date.now();
+    const hits   = [];
+    cached.forEach((entry, i) => {
+      if (entry && entry.vec instanceof Int8Array) {
+        vectors[i] = entry.vec;
+        hits.push([chunkKeys[i], { vec: entry.vec, at: now }]);
+      }
+    });
+    // Bump hits so eviction keeps chunks that are still in use
+    if (hits.length) idbPutMany(IDB_CHUNKS, hits).catch(() => {});
+  } catch {
+    // per-chunk cache unavailable — embed everything
+  }
+  const missing = [];
+  vectors.forEach((vec, i) => { if (!vec) missing.push(i); });
+
   // Show progress bar
   contextProgress.classList.remove('hidden');
   contextResults.classList.add('hidden');
-  setProgress(0, currentChunks.length);
-
-  // Embed in batches of 100 to show progress and avoid huge payloads
-  const BATCH = 100;
-  const allEmbeddings = [];
-  try {
-    for (let i = 0; i < currentChunks.length; i += BATCH) {
-      const batch = currentChunks.slice(i, i + BATCH);
+  setProgress(currentChunks.length - missing.length, currentChunks.length);
+
+  // Embed cache misses in batches of 100 to show progress and avoid huge payloads,
+  // keeping a few requests in flight so wall time isn't the sum of every batch
+  const BATCH       = 100;
+  const CONCURRENCY = 4;
+  let nextBatch = 0;
+  let done      = currentChunks.length - missing.length;
+  // Aborted on the first failure: stops the other workers and cancels their in-flight requests
+  const controller = new AbortController();
+
+  async function embedWorker() {
+    while (nextBatch < missing.length && !controller.signal.aborted) {
+      const idx   = missing.slice(nextBatch, nextBatch + BATCH);
+      nextBatch  += BATCH;
+      const batch = idx.map(k => currentChunks[k]);
       const res   = await fetch(`${API_BASE}/api/embed`, {
         method:  'POST',
         headers: { 'Content-Type': 'application/json' },
         body:    JSON.stringify({ chunks: batch }),
+        signal:  controller.signal,
       });
       if (!res.ok) {
         const err = await res.json().catch(() => ({ detail: 'Embedding failed.' }));
         throw new Error(err.detail || 'Embedding failed.');
       }
       const { embeddings } = await res.json();
-      allEmbeddings.push(...embeddings);
-      setProgress(Math.min(i + BATCH, currentChunks.length), currentChunks.length);
+      if (controller.signal.aborted) return;
+      const now   = Date.now();
+      const fresh = embeddings.map((emb, j) => {
+        const vec = decodeInt8(emb);
+        vectors[idx[j]] = vec;
+        return chunkKeys && [chunkKeys[idx[j]], { vec, at: now }];
+      });
+      // Persist per batch, so a run that fails later still keeps what it paid for
+      if (chunkKeys) idbPutMany(IDB_CHUNKS, fresh).catch(() => {});
+      done += idx.length;
+      setProgress(done, currentChunks.length);
+    }
+  }
+
+  try {
+    const workers = Array.from({ length: CONCURRENCY }, embedWorker);
+    try {
+      await Promise.all(workers);
+    } catch (err) {
+      // Let every worker wind down before embedInProgress is cleared, so a retry can't overlap
+      controller.abort();
+      await Promise.allSettled(workers);
+      throw err;
     }
 
-    currentEmbeddings = allEmbeddings;
+    currentEmbeddings = buildEmbeddingMatrix(vectors);
 
     // Persist to IndexedDB
     if (cacheKey) {
-      idbPut(cacheKey, { embeddings: allEmbeddings }).catch(() => {});
+      idbPut(cacheKey, { rows: vectors }).catch(() => {});
     }
 
     onEmbeddingsReady();
@@ -827,6 +958,7 @@ async function ensureEmbeddings() {
     contextProgress.classList.add('hidden');
   } finally {
     embedInProgress = false;
+    idbTrimOldest(IDB_CHUNKS, CHUNK_CACHE_MAX).catch(() => {});
   }
 }
 
@@ -849,11 +981,101 @@ function onEmbeddingsReady() {
 }
 
 // ── Cosine similarity (client-side) ──────────────────────────────────────────
-function cosine(a, b) {
-  let dot = 0, na = 0, nb = 0;
-  for (let i = 0; i < a.length; i++) { dot += a[i] * b[i]; na += a[i] * a[i]; nb += b[i] * b[i]; }
-  const denom = Math.sqrt(na) * Math.sqrt(nb);
-  return denom === 0 ? 0 : dot / denom;
+/** Pack vectors into one flat Float32Array with unit-length rows, so scoring is a plain dot product. */
+function buildEmbeddingMatrix(vectors) {
+  const count = vectors.length;
+  const dim   = count ? vectors[0].length : 0;
+  const data  = new Float32Array(count * dim);
+  for (let i = 0; i < count; i++) {
+    const vec = vectors[i];
+    let norm = 0;
+    for (let j = 0; j < dim; j++) norm += vec[j] * vec[j];
+    const inv = norm > 0 ? 1 / Math.sqrt(norm) : 0;
+    const off = i * dim;
+    for (let j = 0; j < dim; j++) data[off + j] = vec[j] * inv;
+  }
+  return { data, dim, count };
+}
+
+/** Decode a base64 int8 vector from /api/embed. */
+function decodeInt8(b64) {
+  const bin = atob(b64);
+  const out = new Int8Array(bin.length);
+  for (let i = 0; i < bin.length; i++) out[i] = bin.charCodeAt(i);  // wraps 128..255 to negatives
+  return out;
+}
+
+/** Cosine similarity of the query against every chunk row. */
+function scoreChunks(qVec) {
+  const { data, dim, count } = currentEmbeddings;
+  const q = new Float32Array(dim);
+  let norm = 0;
+  for (let j = 0; j < dim; j++) norm += qVec[j] * qVec[j];
+  const inv = norm > 0 ? 1 / Math.sqrt(norm) : 0;
+  for (let j = 0; j < dim; j++) q[j] = qVec[j] * inv;
+
+  const scores = new Float32Array(count);
+  for (let i = 0, off = 0; i < count; i++, off += dim) {
+    let dot = 0;
+    for (let j = 0; j < dim; j++) dot += data[off + j] * q[j];
+    scores[i] = dot;
+  }
+  return scores;
+}
+
+/** Indices of the k highest scores, best first. Keeps a small sorted buffer instead of sorting all N. */
+function topK(scores, k) {
+  const top = [];  // scores, descending
+  const idx = [];
+  for (let i = 0; i < scores.length; i++) {
+    const s = scores[i];
+    if (top.length === k && s <= top[k - 1]) continue;
+    let pos = top.length === k ? k - 1 : top.length;
+    while (pos > 0 && top[pos - 1] < s) {
+      top[pos] = top[pos - 1];
+      idx[pos] = idx[pos - 1];
+      pos--;
+    }
+    top[pos] = s;
+    idx[pos] = i;
+  }
+  return idx;
+}
+
+// ── Query embedding cache ─────────────────────────────────────────────────────
+// Repeated queries (retyped searches, the same expanded RAG query) skip the API.
+// Promises are cached so concurrent requests for one query share a single fetch.
+const QUERY_CACHE_MAX = 256;
+const queryEmbedCache = new Map();  // query -> Promise<number[]>; Map order doubles as LRU order
+
+function embedQuery(query) {
+  const hit = queryEmbedCache.get(query);
+  if (hit) {
+    queryEmbedCache.delete(query);
+    queryEmbedCache.set(query, hit);
+    return hit;
+  }
+  const pending = fetch(`${API_BASE}/api/embed/query`, {
+    method:  'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body:    JSON.stringify({ query }),
+  }).then(async res => {
+    if (!res.ok) {
+      const err = await res.json().catch(() => ({ detail: 'Search failed.' }));
+      throw new Error(err.detail || 'Search failed.');
+    }
+    const { embedding } = await res.json();
+    return embedding;
+  });
+  // Don't keep failures around
+  pending.catch(() => {
+    if (queryEmbedCache.get(query) === pending) queryEmbedCache.delete(query);
+  });
+  queryEmbedCache.set(query, pending);
+  if (queryEmbedCache.size > QUERY_CACHE_MAX) {
+    queryEmbedCache.delete(queryEmbedCache.keys().next().value);
+  }
+  return pending;
 }
 
 // ── Context search query ──────────────────────────────────────────────────────
@@ -868,24 +1090,13 @@ async function runContextSearch(query) {
 
   try {
     // Only send the query string — cosine similarity runs locally
-    const res = await fetch(`${API_BASE}/api/embed/query`, {
-      method:  'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body:    JSON.stringify({ query }),
-    });
-    if (!res.ok) {
-      const err = await res.json().catch(() => ({ detail: 'Search failed.' }));
-      throw new Error(err.detail || 'Search failed.');
-    }
-    const { embedding: qVec } = await res.json();
+    const qVec = await embedQuery(query);
 
     // Score all chunks locally
     const TOP_K = 8;
-    const scored = currentEmbeddings
-      .map((emb, i) => ({ i, score: cosine(qVec, emb) }))
-      .sort((a, b) => b.score - a.score)
-      .slice(0, TOP_K)
-      .map(({ i, score }) => ({ chunk_index: i, chunk_text: currentChunks[i], score: Math.round(score * 10000) / 10000 }));
+    const scores = scoreChunks(qVec);
+    const scored = topK(scores, TOP_K)
+      .map(i => ({ chunk_index: i, chunk_text: currentChunks[i], score: Math.round(scores[i] * 10000) / 10000 }));
 
     renderContextResults(scored, query);
   } catch (err) {
@@ -1113,18 +1324,10 @@ async function retrieveRagChunks(query) {
   if (!currentEmbeddings || !currentChunks) return [];
 
   try {
-    const res = await fetch(`${API_BASE}/api/embed/query`, {
-      method:  'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body:    JSON.stringify({ query }),
-    });
-    if (!res.ok) return [];
-    const { embedding: qVec } = await res.json();
-
-    return currentEmbeddings
-      .map((emb, i) => ({ chunk_index: i, chunk_text: currentChunks[i], score: cosine(qVec, emb) }))
-      .sort((a, b) => b.score - a.score)
-      .slice(0, ASK_TOP_K);
+    const qVec   = await embedQuery(query);
+    const scores = scoreChunks(qVec);
+    return topK(scores, ASK_TOP_K)
+      .map(i => ({ chunk_index: i, chunk_text: currentChunks[i], score: scores[i] }));
   } catch {
     return [];
   }